@@ -21,7 +21,7 @@ def MERGE_RELATIONSHIPS(subgraph):
     if the relationship has no primary key.
     """
     for relationships in subgraph.relationships:
-        if getattr(relationships, "__primarykey__", None) is None:
+        if relationships.__primarykey__ is None:
             relationships.set_primary_key(_GhostPrimaryKey())
     return subgraph
 
@@ -6,22 +6,25 @@ Main module that converts Relational Database entities into graphs.
 
 authors: Julian Minder
 """
-from typing import Dict, Tuple, Iterable, List, Any
-import sys
+from typing import Dict, Tuple, Iterable, Any
 import logging
 import threading
 from enum import IntEnum
 import time
 import os
 import multiprocessing as mp
-from itertools import chain
+import multiprocessing.util
+from itertools import islice
 import pickle
-from neo4j import GraphDatabase, Auth, Driver
+import ctypes
+import struct
+import tempfile
+from neo4j import GraphDatabase, Auth, Driver, Session
 
 from .resource_iterator import ResourceIterator
-from ..neo4j import Subgraph, Relationship, Node, create, merge
+from ..neo4j import Subgraph, create, merge
 from .schema_compiler import compile_schema
-from .factories import Matcher, Resource
+from .factories import Matcher
 from .global_state import GlobalSharedState
 
 logger = logging.getLogger(__name__)
@@ -31,6 +34,7 @@ class WorkType(IntEnum):
     RELATIONSHIP = 1
 
 __process_config = None
+__process_finalizer = None
 
 
 class WorkerConfig:
@@ -39,6 +43,8 @@ class WorkerConfig:
     Attributes:
         schema: The schema that is used to convert the resources
         factories: The factories that are used to convert the resources
+        node_factories: The node factory of every entity type that produces nodes
+        relationship_factories: The relationship factory of every entity type that produces relationships
         graph_lock: Lock to ensure that only one process is writing to the graph at a time
         neo4j_uri: The uri of the neo4j database
         neo4j_auth: The authentication for the neo4j database 
@@ -49,6 +55,9 @@ class WorkerConfig:
         processed_relationships: Counter for the number of processed relationships
         processed_lock: Lock to ensure that only one process is writing to the counters at a time
     """
+    __slots__ = ("factories", "node_mask", "relationship_mask", "node_factories", "relationship_factories", 
+                 "graph_lock", "neo4j_uri", "neo4j_auth", "exit_flag", "nodes_flag", "processed_resources", 
+                 "processed_nodes", "processed_relationships", "processed_lock", "_graph_driver", "_session")
 
     def __init__(self, neo4j_uri: str, neo4j_auth: Auth) -> None:
         """Initialises a Worker config with the required data. Part of the data is set when the worker is started.
@@ -58,18 +67,21 @@ class WorkerConfig:
             neo4j_auth: The authentication for the neo4j database
         """
         self.factories, self.node_mask, self.relationship_mask = None, None, None
+        self.node_factories, self.relationship_factories = None, None
         self.graph_lock = mp.Lock()
         self.neo4j_uri = neo4j_uri
         self.neo4j_auth = neo4j_auth
         self.exit_flag = mp.Event()
         self.exit_flag.clear()
         self.nodes_flag = mp.Event()
-        self.processed_resources = mp.Value('i', 0)
-        self.processed_nodes = mp.Value('i', 0)
-        self.processed_relationships = mp.Value('i', 0)
+        # The counters are only modified while holding processed_lock, so they don't need a lock of their own
+        self.processed_resources = mp.RawValue(ctypes.c_int64, 0)
+        self.processed_nodes = mp.RawValue(ctypes.c_int64, 0)
+        self.processed_relationships = mp.RawValue(ctypes.c_int64, 0)
         self.processed_lock = mp.Lock()
 
         self._graph_driver = None
+        self._session = None
     
     @property
     def graph_driver(self) -> Driver:
@@ -78,59 +90,84 @@ class WorkerConfig:
             raise ValueError("Graph driver is not set. Please call setup() first.")
         return self._graph_driver
     
+    @property
+    def session(self) -> Session:
+        """Gets the session used for commits. It is opened on first use and reused for all batches of the process."""
+        if self._session is None:
+            self._session = self.graph_driver.session()
+        return self._session
+
     def setup(self) -> None:
         """Sets up the worker config. This is called when the worker is started."""
         self._graph_driver = GraphDatabase.driver(self.neo4j_uri, auth=self.neo4j_auth)
 
+    def teardown(self) -> None:
+        """Closes the commit session and the graph driver that was created in setup()."""
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        if self._graph_driver is not None:
+            self._graph_driver.close()
+            self._graph_driver = None
+
     def set_work_type(self, work_type: WorkType):
         if work_type == WorkType.NODE:
             self.nodes_flag.set()
         else:
             self.nodes_flag.clear()
 
-def commit_wrap(function):
-    """Wraps the graph commit function into try except block with retry. """
+def commit_wrap(function, lock = None):
+    """Wraps the graph commit function into try except block with retry. 
+    
+    Args:
+        function: The commit function
+        lock: Optional lock held by the caller. It is released while waiting for the retry, 
+            such that other processes can commit in the meantime.
+    """
     try:
         function()
     except Exception as e:
         logger.error(f"Neo4j Exception '{type(e).__name__}': " + str(e))
         logger.error("Sleeping for 10 second and retrying commit")
-        time.sleep(10)
+        if lock is not None:
+            lock.release()
+        try:
+            time.sleep(10)
+        finally:
+            if lock is not None:
+                lock.acquire()
         function()
 
-def commit_batch(to_create: Subgraph, to_merge: Subgraph) -> None:
-        """"Commits processed batch to graph."""
+def commit_batch(nodes_to_create: Subgraph, relationships_to_create: Subgraph, to_merge: Subgraph) -> Tuple[int, int]:
+        """"Commits processed batch to graph. Returns the number of committed nodes and relationships."""
+        # Subgraph.nodes/relationships copy the underlying sets into tuples on every access, so count once
+        num_nodes_to_create = len(nodes_to_create.nodes)
+        num_relationships_to_create = len(relationships_to_create.relationships)
+        num_nodes_to_merge = len(to_merge.nodes)
+        num_relationships_to_merge = len(to_merge.relationships)
         nodes_committed = 0 
         relationships_committed = 0
+        # The session of the process is reused for all commits
+        session = __process_config.session
         
         # Creating nodes does not rely on serialized executions
-        # If there are relationships to create, we need to serialize the creation
-        # TODO: We could split the creation of nodes and relationships into two separate branches, might be more efficient
-        #       but considering that in almost all cases no relationships are created in the first loop, it's not worth it
-        if len(to_create.relationships) > 0:
-            with __process_config.graph_lock:
-                with __process_config.graph_driver.session() as session:
-                    commit_wrap(lambda: create(to_create, session))
-            relationships_committed += len(to_create.relationships)
-        elif len(to_create.nodes) > 0:
-            with __process_config.graph_driver.session() as session:
-                commit_wrap(lambda: create(to_create, session))
-            nodes_committed += len(to_create.nodes)
-
-        # Merging nodes requires serialization (synchronous executions) between processes
-        # Using locks to enforce this
-        if len(to_merge.nodes) + len(to_merge.relationships) > 0:
+        if num_nodes_to_create > 0:
+            commit_wrap(lambda: create(nodes_to_create, session))
+            nodes_committed += num_nodes_to_create
+
+        # Creating relationships and merging require serialization (synchronous executions) between processes
+        # Using one lock acquisition for both to enforce this
+        if num_relationships_to_create + num_nodes_to_merge + num_relationships_to_merge > 0:
             with __process_config.graph_lock:
-                with __process_config.graph_driver.session() as session:
-                    commit_wrap(lambda: merge(to_merge, session))
-            nodes_committed += len(to_merge.nodes)
-            relationships_committed += len(to_merge.relationships)
+                if num_relationships_to_create > 0:
+                    commit_wrap(lambda: create(relationships_to_create, session), __process_config.graph_lock)
+                if num_nodes_to_merge + num_relationships_to_merge > 0:
+                    commit_wrap(lambda: merge(to_merge, session), __process_config.graph_lock)
+            relationships_committed += num_relationships_to_create
+            nodes_committed += num_nodes_to_merge
+            relationships_committed += num_relationships_to_merge
 
-        # Update the processed nodes and relations
-        if nodes_committed > 0 or relationships_committed > 0:
-            with __process_config.processed_lock:
-                __process_config.processed_nodes.value += nodes_committed
-                __process_config.processed_relationships.value += relationships_committed
+        return nodes_committed, relationships_committed
 
 def process_batch(batch) -> None:
     """
@@ -141,27 +178,29 @@ def process_batch(batch) -> None:
     # __process_config is a global variable that contains the configuration for the current process
     batch = pickle.loads(batch)
     try:
-        work_type = WorkType.NODE if __process_config.nodes_flag.is_set() else WorkType.RELATIONSHIP
-        mask = __process_config.node_mask if work_type == WorkType.NODE else __process_config.relationship_mask
+        is_node_pass = __process_config.nodes_flag.is_set()
+        factories = __process_config.node_factories if is_node_pass else __process_config.relationship_factories
         to_merge = [[], []] # List of resources to merge (nodes, rels)
         to_create = [[], []] # List of resources to create (nodes, rels)
-        processed_resources = []
-        for i, resource in enumerate(batch) :
-            if __process_config.exit_flag.is_set():
+        # Bind everything the loop needs per resource to locals once per batch
+        exit_flag_is_set = __process_config.exit_flag.is_set
+        merge_nodes, merge_relationships = to_merge
+        create_nodes, create_relationships = to_create
+        for resource in batch:
+            if exit_flag_is_set():
                 # If the exit flag is set, we stop processing
                 return []
-            if resource.type in mask:
-                # If the resource is not in the mask (meaning we don't need to convert it), we skip it
-                # This is mainly done for performance reasons, as the conversion is not needed
-
-                logger.debug(f"Processing {resource}")
-                
-                factory = __process_config.factories[resource.type][int(work_type)]
+            # The factory tables only contain the types in the mask. If the resource is not in the 
+            # mask (meaning we don't need to convert it), we skip it
+            # This is mainly done for performance reasons, as the conversion is not needed
+            factory = factories.get(resource.type)
+            if factory is not None:
+                logger.debug("Processing %s", resource)
 
                 try:
                     subgraph = factory.construct(resource)
                 except Exception as err:
-                    err.args += (f"Encountered error when processing {'nodes' if __process_config.nodes_flag.is_set() else 'relationships'} of {resource}.",)
+                    err.args += (f"Encountered error when processing {'nodes' if is_node_pass else 'relationships'} of {resource}.",)
                     raise err
                 
                 
@@ -172,28 +211,30 @@ def process_batch(batch) -> None:
                 for node in subgraph.nodes:
                     if node.__primarykey__ is not None:
                         # If a primary key is existing we merge the node to the graph
-                        to_merge[0].append(node)
+                        merge_nodes.append(node)
                     else:
-                        to_create[0].append(node)
+                        create_nodes.append(node)
                 for relationship in subgraph.relationships:
-                    if getattr(relationship, "__primarykey__", None) is not None:
+                    if relationship.__primarykey__ is not None:
                         # If a primary key is existing we merge the relationship to the graph
-                        to_merge[1].append(relationship)
-                        pass
+                        merge_relationships.append(relationship)
                     else:
                         # If no primary key is existing we create the relationship to the graph
                         relationship.__primarykey__ = -1
-                        to_create[1].append(relationship)
-            processed_resources.append(resource)
+                        create_relationships.append(relationship)
 
         
-        to_create = Subgraph(*to_create)
+        # Nodes that already exist in the graph (e.g. matched endpoints of relationships) are not created again
+        nodes_to_create = Subgraph(nodes=[node for node in create_nodes if node.identity is None])
+        relationships_to_create = Subgraph(relationships=create_relationships)
         to_merge = Subgraph(*to_merge)
-        commit_batch(to_create, to_merge)
+        nodes_committed, relationships_committed = commit_batch(nodes_to_create, relationships_to_create, to_merge)
 
-        # Update counter
+        # Update all counters with a single lock acquisition per batch
         with __process_config.processed_lock:
-            __process_config.processed_resources.value += len(processed_resources)
+            __process_config.processed_resources.value += len(batch)
+            __process_config.processed_nodes.value += nodes_committed
+            __process_config.processed_relationships.value += relationships_committed
 
             
     except Exception as err:
@@ -201,9 +242,9 @@ def process_batch(batch) -> None:
         logger.debug(f"Exiting Worker " + str(mp.current_process().pid))
         raise err
     
-    if work_type == WorkType.NODE:
+    if is_node_pass:
         # For memory reasons we return the processed resources as a binary string
-        bin_resources = pickle.dumps(processed_resources)
+        bin_resources = pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL)
         return bin_resources
     else:
         # No need to return anything for relationship as no synchronization is needed
@@ -219,54 +260,96 @@ class Batcher:
         return self
 
     def __next__(self):
-        batch = []
-        for _ in range(self._batch_size):
-            try:
-                batch.append(next(self._iterator))
-            except StopIteration:
-                if len(batch) == 0:
-                    raise StopIteration
-                break
+        # Pull the whole batch in one call instead of catching StopIteration per resource
+        batch = list(islice(self._iterator, self._batch_size))
+        if len(batch) == 0:
+            raise StopIteration
         if self._binarize:
-            batch = pickle.dumps(batch)
+            batch = pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL)
         return batch
 
+class BatchSpool:
+    """Keeps the pickled batches returned by the node pass in a temporary file instead of in memory until 
+    they are needed for the relationship pass. Iterating over the spool yields the batches in the order they were added."""
+    _HEADER = struct.Struct("<Q")
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, batch: bytes) -> None:
+        # Each batch is stored with its length as prefix
+        self._file.write(self._HEADER.pack(len(batch)))
+        self._file.write(batch)
+
+    def __iter__(self):
+        self._file.seek(0)
+        while True:
+            header = self._file.read(self._HEADER.size)
+            if not header:
+                return
+            yield self._file.read(self._HEADER.unpack(header)[0])
+
+    def close(self) -> None:
+        self._file.close()
+
 def update_progress_bar(progress_bar, num, exit_flag) -> None:
-    while(True):
-        if exit_flag.is_set():
-            return
+    # Waiting on the exit flag instead of sleeping lets the updater return as soon as the conversion is done
+    while not exit_flag.wait(0.1):
+        # The counter is read without taking processed_lock, a slightly stale value is fine for the progress bar
         n = num.value
         # Set value of progress bar
         progress_bar.n = n
         progress_bar.refresh()
-        time.sleep(0.1)
 
 def init_process_state(proc_config: WorkerConfig, conversion_objects: Tuple, global_shared_state: Dict[str, Any]):
     '''Initialize each process with a global config.
     '''
-    global __process_config
+    global __process_config, __process_finalizer
     __process_config = proc_config
     # Setup the worker config in the local process (this sets up the graph driver)
     __process_config.setup()
+    # Pool workers never call cleanup_process_state, the finalizer releases their sessions when the worker exits.
+    # It is registered right after the driver is opened, such that the driver is released even if the initialization fails.
+    __process_finalizer = mp.util.Finalize(None, release_process_sessions, args=(__process_config,), exitpriority=10)
 
     # Load the conversion objects
     factories,node_mask,relationship_mask = conversion_objects
     __process_config.factories = factories
     __process_config.node_mask = node_mask
     __process_config.relationship_mask = relationship_mask
+    # Select the factory for every work type once, so the workers don't need to index it per resource
+    __process_config.node_factories = {entity_type: factories[entity_type][WorkType.NODE] for entity_type in node_mask}
+    __process_config.relationship_factories = {entity_type: factories[entity_type][WorkType.RELATIONSHIP] for entity_type in relationship_mask}
     
     # Set driver for matcher
     # TODO: This is a hacky way to set the matcher to the graph. 
-    Matcher.graph_driver = __process_config.graph_driver
+    Matcher._set_graph_driver(__process_config.graph_driver)
 
     # Set the global shared state
     GlobalSharedState.set_state(global_shared_state)
     GlobalSharedState._set_graph_driver(__process_config.graph_driver)
 
+def release_process_sessions(proc_config: WorkerConfig):
+    '''Closes the matcher session, the commit session and the graph driver of the process.
+    '''
+    Matcher._set_graph_driver(None)
+    proc_config.teardown()
+
 def cleanup_process_state():
     '''Cleanup the process state. Only used in serial processing.
     '''
-    global __process_config
+    global __process_config, __process_finalizer
+    # Release the sessions now, the main process may live on after the conversion. 
+    # Calling the finalizer also unregisters it, such that it does not run again at exit.
+    if __process_finalizer is not None:
+        __process_finalizer()
+    __process_finalizer = None
     del __process_config
     __process_config = None
     GlobalSharedState._del_graph_driver()
@@ -283,7 +366,7 @@ class Converter:
             iterator: The resource iterator.
             neo4j_uri: The uri of the neo4j database.
             neo4j_auth: The authentication for the neo4j database.
-            num_workers: The number of parallel workers. Please make sure that your usage supports parallelism. To use serial processing set this to 1. (default: cpu_count-2)
+            num_workers: The number of parallel workers. Please make sure that your usage supports parallelism. To use serial processing set this to 1. (default: cpu_count-2, at least 1)
             serialize: If true, the converter will make sure that all resources are processed serially and does not use any buffering. This is useful if you want to make sure that all resources are processed 
                 and committed to the graph in the same order as they are returned by the iterator. Note that you can't set both serialize to true and set num_workers > 1. (default: False)
             batch_size: The batch size for the parallel processing. (default: 5000)
@@ -294,7 +377,8 @@ class Converter:
             else:
                 num_workers = 1
         elif num_workers is None:
-            num_workers = mp.cpu_count() - 2
+            # Leave two cores for the main process and the database, but always use at least one worker
+            num_workers = max(1, (os.cpu_count() or 1) - 2)
         
         # Verify connection to neo4j
         self._neo4j_uri = neo4j_uri
@@ -330,21 +414,20 @@ class Converter:
         """Sets the resource iterator"""
         self._iterator = iterator
 
-    def _process_iteration(self, pool: mp.Pool, iterator: Iterable, config: WorkerConfig) -> None:
-        """Runs one iteration of the conversion pipeline.
+    def _process_iteration(self, pool: mp.Pool, iterator: Iterable, config: WorkerConfig, spool: BatchSpool = None) -> None:
+        """Runs one iteration of the conversion pipeline. If a spool is given, the processed batches are added to it.
         """
-        processed_resources = []
         try:
             result = pool.imap_unordered(process_batch, iterator)
-            for i, batch in enumerate(result):
-                processed_resources.append(batch)
+            for batch in result:
+                if spool is not None:
+                    spool.append(batch)
         except KeyboardInterrupt as e:
             # KeyboardInterrupt is raised on the main exec thread
             # -> Cleanup all workers
             config.exit_flag.set()
             pool.terminate()
             raise e
-        return processed_resources
 
     def __call__(self, progress_bar: "tdqm.tqdm" = None, skip_nodes = False, skip_relationships = False) -> None:
         """Runs the convertion and commits the produced nodes and relationships to the graph.
@@ -361,9 +444,12 @@ class Converter:
         # Handle progress bar (create new or update it)
         pb = None
         if progress_bar is not None:
-            pb = progress_bar(total=2*len(self._iterator))
+            num_resources = len(self._iterator)
+            pb = progress_bar(total=2*num_resources)
             if skip_nodes:
-                pb.update(len(self._iterator))
+                # The progress bar is set from the processed resources counter, so the skipped node pass is counted there
+                config.processed_resources.value = num_resources
+                pb.update(num_resources)
             
             pb_updater = threading.Thread(target=update_progress_bar, args=(pb, config.processed_resources, config.exit_flag), daemon=True)
             pb_updater.start()
@@ -373,16 +459,20 @@ class Converter:
 
         if not self._serialize:
             logger.info(f"Running convertion with {self._num_workers} parallel workers.")
-            with mp.Pool(processes=self._num_workers, initializer=init_process_state, 
+            # The spool is entered first, such that it is only closed after the pool has stopped reading from it
+            with BatchSpool() as spool, mp.Pool(processes=self._num_workers, initializer=init_process_state, 
                         initargs=(config, conversion_objects, GlobalSharedState.get_state()), 
                         maxtasksperchild=50) as pool:
                 if not skip_nodes:
                     config.set_work_type(WorkType.NODE)
                     logger.info("Starting creation of nodes.")
                     
-                    processed_batches = self._process_iteration(pool, Batcher(self._batch_size, self._iterator), config)
+                    self._process_iteration(pool, Batcher(self._batch_size, self._iterator), config, spool)
+                    processed_batches = spool
                 else:
                     logger.info("Skipping creation of nodes.")
+                    # Without a node pass, the relationship pass streams the resources directly from the iterator
+                    processed_batches = Batcher(self._batch_size, self._iterator)
 
                 if not skip_relationships:  
                     config.set_work_type(WorkType.RELATIONSHIP)
@@ -391,9 +481,14 @@ class Converter:
                     self._process_iteration(pool, processed_batches, config)
                 else:
                     logger.info("Skipping creation of relations.")
+
+                # Let the workers exit normally, such that their finalizers release the sessions
+                pool.close()
+                pool.join()
         else:
 
             # Serialize the processing
+            spool = BatchSpool()
             try:
                 # Initialize the process state
                 init_process_state(config, conversion_objects, GlobalSharedState.get_state())
@@ -401,12 +496,13 @@ class Converter:
                 if not skip_nodes:
                     config.set_work_type(WorkType.NODE)
                     logger.info("Starting creation of nodes.")
-                    pmap = map(process_batch, Batcher(self._batch_size, self._iterator))
-                    processed_batches = []
-                    for batch in pmap:
-                        processed_batches.append(batch)
+                    for batch in map(process_batch, Batcher(self._batch_size, self._iterator)):
+                        spool.append(batch)
+                    processed_batches = spool
                 else:
                     logger.info("Skipping creation of nodes.")
+                    # Without a node pass, the relationship pass streams the resources directly from the iterator
+                    processed_batches = Batcher(self._batch_size, self._iterator)
 
                 if not skip_relationships:
                     config.set_work_type(WorkType.RELATIONSHIP)
@@ -417,6 +513,7 @@ class Converter:
             finally:
                 # Cleanup the process state
                 cleanup_process_state()
+                spool.close()
         
         # make sure that the progress bar is updated one last time
         if pb is not None:
@@ -424,6 +521,5 @@ class Converter:
             pb_updater.join()
             pb.n = config.processed_resources.value
             pb.refresh()
-            time.sleep(0.1)
             pb.close()
         logger.info(f"Processed in total {config.processed_nodes.value} nodes and {config.processed_relationships.value} relationships (this run took {int(time.time()-start)}s)")
\ No newline at end of file
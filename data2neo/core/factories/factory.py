@@ -230,7 +230,7 @@ class RelationshipFactory(SubgraphFactory):
         from_nodes = self._from_matcher.match(resource)
         to_nodes = self._to_matcher.match(resource)
         rel_type = self._type.construct(resource)
-        logger.debug(f"For relation type {rel_type.value} matched {len(from_nodes)} from_nodes and {len(to_nodes)} to nodes")
+        logger.debug("For relation type %s matched %d from_nodes and %d to nodes", rel_type.value, len(from_nodes), len(to_nodes))
         attributes = [attr_factory.construct(resource) for attr_factory in self._attributes]
         attributes = [attr for attr in attributes if attr is not None]
         relations = Subgraph()
@@ -19,6 +19,10 @@ class Matcher:
     """
     graph_driver: 'GraphDatabase' = None
 
+    # Session on graph_driver that is reused for all matches of the current process
+    _session: 'Session' = None
+    _session_driver: 'GraphDatabase' = None
+
 
     def __init__(self, node_id: str = None, *conditions: 'AttributeFactory') -> None:
         """Inits a Matcher with either a node_id XOR a list of conditions
@@ -52,6 +56,26 @@ class Matcher:
             raise ValueError("At least one label must be provided")
 
 
+    @staticmethod
+    def _set_graph_driver(driver: 'GraphDatabase') -> None:
+        """Sets the graph driver used for matching and closes the session that was opened on the previous driver."""
+        if Matcher._session is not None:
+            Matcher._session.close()
+        Matcher._session, Matcher._session_driver = None, None
+        Matcher.graph_driver = driver
+
+    @staticmethod
+    def _get_session() -> 'Session':
+        """Returns a session on the graph driver. Opening a session for every match is expensive, so the session
+        is kept and reused until the graph driver is replaced."""
+        if Matcher._session_driver is not Matcher.graph_driver:
+            # The graph driver was replaced through the public attribute, close the session on the stale driver
+            Matcher._set_graph_driver(Matcher.graph_driver)
+        if Matcher._session is None:
+            Matcher._session = Matcher.graph_driver.session()
+            Matcher._session_driver = Matcher.graph_driver
+        return Matcher._session
+
     def match(self, resource: Resource) -> List[Node]:
         """Matches Nodes based on the settings (from init) and the resource
         
@@ -77,7 +101,7 @@ class Matcher:
             constructed_labels = [label_factory.construct(resource) for label_factory in self._labels]
             parsed_labels = [attr.value for attr in constructed_labels if attr is not None]
 
-            logger.debug(f"Matching based on labels: '{parsed_labels}' and conditions: {parsed_conditions}")
+            logger.debug("Matching based on labels: '%s' and conditions: %s", parsed_labels, parsed_conditions)
             
             if len(parsed_conditions) == 0:
                 keys, values = [], []
@@ -91,9 +115,8 @@ class Matcher:
             clause = _match_clause("n", (tuple(parsed_labels), *keys), value)
             clause, params = cypher_join("UNWIND $data AS r", clause, "RETURN LABELS(n) as labels, n as properties, id(n) as identity", data=[values])
 
-            with Matcher.graph_driver.session() as session:
-                match_list = session.run(clause, **params).data()
-                logger.debug(f"Found {len(match_list)} matches")
+            match_list = Matcher._get_session().run(clause, **params).data()
+            logger.debug("Found %d matches", len(match_list))
 
             # Convert to nodes
             match_list = [Node.from_dict(r['labels'], r['properties'], identity=r["identity"]) for r in match_list]
@@ -12,10 +12,8 @@ authors: Julian Minder
 """
 
 from typing import List, Any
-from collections import Counter
 import re
 import logging
-from numpy import extract
 from ply import lex, yacc
 
 from .factories.registrar import get_factory
@@ -101,7 +99,7 @@ class SchemaConfigParser:
         self.lexer = lex.lex(module=self)
         self.parser = yacc.yacc(module=self, debug=False)
 
-        self._identifiers = [] # used to verify that an identifier is only used once per entity
+        self._identifiers = {} # used to verify that an identifier is only used once per entity (identifier -> is duplicated)
 
     def tokenize(self, data):
         self.lexer.input(data)
@@ -112,7 +110,7 @@ class SchemaConfigParser:
             print(tok)
 
     def parse(self, data):
-        return self.parser.parse(data)
+        return self.parser.parse(data, lexer=self.lexer)
 
     def p_entities(self, p):
         '''entities : entity entities
@@ -130,12 +128,12 @@ class SchemaConfigParser:
         '''
         p[0] = [self._cleanup_string(p[3]), p[6]]
         # verify that every identifier is only used once per entity
-        identifier_counts = Counter(self._identifiers)
-        duplicated_identifiers = [key for key in identifier_counts.keys() if identifier_counts[key]>1]
+        # the dict keeps the order of first occurrence
+        duplicated_identifiers = [key for key, duplicated in self._identifiers.items() if duplicated]
         if len(duplicated_identifiers):
             raise SchemaConfigException(f"Found conflicting definitions of identifiers {duplicated_identifiers} in entity '{p[0][0]}'. An identifier must be unique.")
-        # clear identifier list
-        self._identifiers = []
+        # clear identifier tracking
+        self._identifiers = {}
 
     @staticmethod
     def _extract_key_from_attribute(attribute):
@@ -194,7 +192,8 @@ class SchemaConfigParser:
                       | empty'''
         p[0] = p[1]
         if p[0] is not None:
-            self._identifiers.append(p[0])
+            # duplicates are tracked incrementally instead of being counted at the end of the entity
+            self._identifiers[p[0]] = p[0] in self._identifiers
 
     def p_graphelement(self, p):
         '''graphelement : node
@@ -319,14 +318,19 @@ class SchemaConfigParser:
         return value
 
 
+_COMMENT_PATTERN = re.compile("#.*")
+
+
 def _precompile(input_string):
-    # Remove all comments
-    match = re.search("#.*", input_string)
-    while match is not None:
-        input_string = input_string[:match.start()] + \
-            input_string[match.end():]
-        match = re.search("#.*", input_string)
-    return input_string
+    # Remove all comments. The segments between comments are collected and joined once,
+    # instead of rebuilding the whole string for every removed comment.
+    segments = []
+    position = 0
+    for match in _COMMENT_PATTERN.finditer(input_string):
+        segments.append(input_string[position:match.start()])
+        position = match.end()
+    segments.append(input_string[position:])
+    return "".join(segments)
 
 
 def _unravel_args(args: List[Any]) -> List[Any]:
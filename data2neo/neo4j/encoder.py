@@ -36,7 +36,10 @@ SINGLE_QUOTE = u"'"
 ESCAPED_DOUBLE_QUOTE = u'\\"'
 ESCAPED_SINGLE_QUOTE = u"\\'"
 
-X_ESCAPE = re_compile(r"(\\x([0-9a-f]{2}))")
+# Single pass tokenizer over unicode-escaped text: escaped backslashes, hex escapes and quotes
+DOUBLE_QUOTED_ESCAPE = re_compile(r'(?P<backslash>\\\\)|\\x(?P<hex>[0-9a-f]{2})|(?P<quote>")')
+SINGLE_QUOTED_ESCAPE = re_compile(r"(?P<backslash>\\\\)|\\x(?P<hex>[0-9a-f]{2})|(?P<quote>')")
+HEX_ESCAPES = {u"08": u"\\b", u"0c": u"\\f"}
 DOUBLE_QUOTED_SAFE = re_compile(r"([ -!#-\[\]-~]+)")
 SINGLE_QUOTED_SAFE = re_compile(r"([ -&(-\[\]-~]+)")
 
@@ -65,7 +68,7 @@ ustr = lambda s: xstr(s, encoding)
 
 def is_safe_key(key):
     key = ustr(key)
-    return key[0] in ID_START and all(key[i] in ID_CONTINUE for i in range(1, len(key)))
+    return key[0] in ID_START and ID_CONTINUE.issuperset(key[1:])
 
 
 class CypherExpression:
@@ -97,18 +100,28 @@ def encode_string(value):
     if quote == SINGLE_QUOTE:
         escaped_quote = ESCAPED_SINGLE_QUOTE
         safe = SINGLE_QUOTED_SAFE
+        escape = SINGLE_QUOTED_ESCAPE
     else: # quote == DOUBLE_QUOTE:
         escaped_quote = ESCAPED_DOUBLE_QUOTE
         safe = DOUBLE_QUOTED_SAFE
+        escape = DOUBLE_QUOTED_ESCAPE
 
 
     if not value:
         return quote + quote
 
+    def dispatch(match):
+        kind = match.lastgroup
+        if kind == "hex":
+            hex_value = match.group("hex")
+            return HEX_ESCAPES.get(hex_value, u"\\u00" + hex_value)
+        if kind == "quote":
+            return escaped_quote
+        return match.group(0)
+
     parts = safe.split(value)
     for i in range(0, len(parts), 2):
-        parts[i] = (X_ESCAPE.sub(u"\\\\u00\\2", parts[i].encode("unicode-escape").decode("utf-8")).
-                    replace(quote, escaped_quote).replace(u"\\u0008", u"\\b").replace(u"\\u000c", u"\\f"))
+        parts[i] = escape.sub(dispatch, parts[i].encode("unicode-escape").decode("utf-8"))
     return quote + u"".join(parts) + quote
 
 def encode_list(values):
@@ -93,6 +93,36 @@ class _GhostPrimaryKey:
     """
     pass
 
+
+def _group_by_primary_value(nodes, primary_key):
+    """Groups nodes that share the same value for their primary key, such that each value is merged only once.
+
+    Args:
+        nodes: List of nodes with the same primary label, primary key and labels
+        primary_key: The primary key (or tuple of keys) of the nodes
+    Returns:
+        A tuple (rows, groups) where rows[i] are the combined properties of the nodes in groups[i]. 
+        Properties of later nodes override earlier ones, like consecutive SET += clauses would.
+    """
+    keys = primary_key if isinstance(primary_key, tuple) else (primary_key,)
+    rows, groups, index = [], [], {}
+    for node in nodes:
+        properties = dict(node)
+        # The type is part of the key as e.g. True == 1 in python but not in cypher
+        value = tuple((type(properties.get(key)), properties.get(key)) for key in keys)
+        try:
+            i = index.setdefault(value, len(rows))
+        except TypeError:
+            # Unhashable values (e.g. lists) are not deduplicated
+            i = len(rows)
+        if i == len(rows):
+            rows.append(properties)
+            groups.append([node])
+        else:
+            rows[i].update(properties)
+            groups[i].append(node)
+    return rows, groups
+
 class Subgraph(GraphElement):
     """ 
     A :class:`.Subgraph` is an arbitrary collection of nodes and
@@ -150,7 +180,8 @@ class Subgraph(GraphElement):
     def __init__(self, nodes=None, relationships=None):
         self.__nodes = frozenset(nodes or [])
         self.__relationships = frozenset(relationships or [])
-        self.__nodes |= frozenset(chain.from_iterable(r.nodes for r in self.__relationships))
+        # Read the endpoints directly instead of through Relationship.nodes, which copies its node set into a tuple
+        self.__nodes |= frozenset(chain.from_iterable((r.start_node, r.end_node) for r in self.__relationships))
         #if not self.__nodes:
         #    raise ValueError("Subgraphs must contain at least one node")
 
@@ -240,7 +271,7 @@ class Subgraph(GraphElement):
         for relationship in self.relationships:
             if relationship.identity is None:
                 # Determine primary key
-                if getattr(relationship, "__primarykey__", None) is not None:
+                if relationship.__primarykey__ is not None:
                     p_key = relationship.__primarykey__
                 else:
                     p_key = primary_key
@@ -250,18 +281,20 @@ class Subgraph(GraphElement):
         for (pl, pk, labels), nodes in node_dict.items():
             if pl is None or pk is None:
                 raise ValueError("Primary label and primary key are required for node MERGE operation")
-            pq = unwind_merge_nodes_query(map(dict, nodes), (pl, pk), labels)
-             # TODO: id() is deprecated, in the future we need to move to something else
+            # Nodes with the same primary value are sent once and all receive the identity of the merged node
+            rows, groups = _group_by_primary_value(nodes, pk)
+            pq = unwind_merge_nodes_query(rows, (pl, pk), labels)
+             # TODO: id() is deprecated, in the future we need to move to something else
             pq = cypher_join(pq, "RETURN id(_)")
             identities = [record[0] for record in tx.run(*pq)]
-            if len(identities) > len(nodes):
+            if len(identities) > len(rows):
                 raise ValueError("Found %d matching nodes for primary label %r and primary "
                                         "key %r with labels %r but merging requires no more than "
                                         "one" % (len(identities), pl, pk, set(labels)))
-            for i, identity in enumerate(identities):
-                node = nodes[i]
-                node.identity = identity
-                node._remote_labels = frozenset(labels)
+            for identity, group in zip(identities, groups):
+                for node in group:
+                    node.identity = identity
+                    node._remote_labels = frozenset(labels)
         for (pk, r_type), relationships in rel_dict.items():
             if pk is None:
                 raise ValueError("Primary key are required for relationship MERGE operation")
@@ -159,3 +159,20 @@ def test_raise_when_serialize_and_multiple_workers(session, uri, auth):
         converter = Converter(load_file(schema_file_name), iterator, uri, auth, serialize=True, num_workers=10)
     exception_msg = excinfo.value.args[0]
     assert exception_msg == "You can't use serialization and parallel processing (num_workers > 1) at the same time."
+
+@pytest.mark.parametrize("serialize,workers",[(True, None), (False, 1), (False, 5)])
+def test_skip_nodes(serialize, workers, session, uri, auth):
+    """Tests that relationships can be created in a separate run that skips the creation of nodes."""
+    entities = pd.DataFrame({"uid": range(10)})
+    relations = pd.DataFrame({"from": range(5), "to": range(5, 10)})
+    iterator = IteratorIterator([PandasDataFrameIterator(entities, "Entity"), PandasDataFrameIterator(relations, "Relationship")])
+    converter = Converter(load_file("tests/integration/resources/schema_concurrency.yaml"), iterator, uri, auth, 
+                          serialize=serialize, num_workers=workers, batch_size=3)
+
+    converter(skip_relationships=True)
+    assert num_nodes(session) == 10
+    assert num_relationships(session) == 0
+
+    converter(skip_nodes=True)
+    assert num_nodes(session) == 10
+    assert num_relationships(session) == 10
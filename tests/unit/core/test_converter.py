@@ -11,6 +11,7 @@ authors: Julian Minder
 import pytest
 import neo4j
 from data2neo import Converter
+from data2neo.core.converter import BatchSpool
 
 import warnings
 
@@ -40,4 +41,17 @@ def test_deprecated():
         Converter("RELATION()", None, "bolt://localhost:7687", ("neo4j", "password"))
 
     exception_msg = excinfo.value.args[0]
-    assert "The RELATION keyword is deprecated. Please use RELATIONSHIP instead." in exception_msg
\ No newline at end of file
+    assert "The RELATION keyword is deprecated. Please use RELATIONSHIP instead." in exception_msg
+
+def test_batch_spool():
+    batches = [b"first", b"", b"\x00" * 10000, b"last"]
+    with BatchSpool() as spool:
+        for batch in batches:
+            spool.append(batch)
+        assert list(spool) == batches
+        # the spool can be iterated multiple times
+        assert list(spool) == batches
+
+    # an empty spool yields no batches
+    with BatchSpool() as spool:
+        assert list(spool) == []
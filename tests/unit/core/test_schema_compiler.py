@@ -120,6 +120,21 @@ def test_parser_raises_identifier_twice():
     exception_msg = excinfo.value.args[0]
     assert exception_msg == "Found conflicting definitions of identifiers ['node'] in entity 'entity'. An identifier must be unique."
 
+def test_parser_raises_identifiers_twice_in_order():
+    """Tests if duplicated identifiers are reported in the order of their first definition."""
+    input_string = """
+    ENTITY('entity'):
+        NODE("label") a:
+        NODE("label") b:
+        NODE("label") b:
+        NODE("label") a:
+    """
+    with pytest.raises(SchemaConfigException) as excinfo:
+        parser = SchemaConfigParser()
+        parser.parse(input_string)
+    exception_msg = excinfo.value.args[0]
+    assert exception_msg == "Found conflicting definitions of identifiers ['a', 'b'] in entity 'entity'. An identifier must be unique."
+
 def test_parser_raises_two_primary_keys():
     """Test if parser correctly raises an exception if a graphelement has two defined primary keys."""
     input_string = """
@@ -12,6 +12,7 @@ import pytest
 import pickle
 
 from data2neo.neo4j import Node, Relationship, Subgraph
+from data2neo.neo4j.graph_elements import _group_by_primary_value
 from data2neo import Attribute
 
 def test_attributes():
@@ -287,3 +288,64 @@ def test_serializable():
     assert r1 == r1_unpickle
     assert r1.identity == r1_unpickle.identity
 
+
+
+def _merge_node(label, **properties):
+    node = Node(label, **properties)
+    node.set_primary_key("id")
+    return node
+
+def test_group_by_primary_value():
+    # same value is merged, later properties override earlier ones
+    n1 = _merge_node("test", id=1, name="a", age=1)
+    n2 = _merge_node("test", id=1, age=2)
+    n3 = _merge_node("test", id=2)
+    rows, groups = _group_by_primary_value([n1, n2, n3], "id")
+    assert rows == [{"id": 1, "name": "a", "age": 2}, {"id": 2}]
+    assert groups == [[n1, n2], [n3]]
+
+    # True and 1 are equal in python but not in cypher
+    n4 = _merge_node("test", id=True)
+    rows, groups = _group_by_primary_value([n1, n4], "id")
+    assert rows == [{"id": 1, "name": "a", "age": 1}, {"id": True}]
+    assert groups == [[n1], [n4]]
+
+    # tuple primary keys
+    n5 = Node("test", a=1, b=1)
+    n6 = Node("test", a=1, b=2)
+    n7 = Node("test", a=1, b=1, c=3)
+    rows, groups = _group_by_primary_value([n5, n6, n7], ("a", "b"))
+    assert rows == [{"a": 1, "b": 1, "c": 3}, {"a": 1, "b": 2}]
+    assert groups == [[n5, n7], [n6]]
+
+    # unhashable values are not deduplicated
+    n8 = _merge_node("test", id=[1])
+    n9 = _merge_node("test", id=[1])
+    rows, groups = _group_by_primary_value([n8, n9], "id")
+    assert rows == [{"id": [1]}, {"id": [1]}]
+    assert groups == [[n8], [n9]]
+
+
+class _StubTx:
+    """Transaction stub that returns a new identity for every row of a query."""
+    def __init__(self):
+        self.rows = []
+
+    def run(self, query, parameters=None, **kwparameters):
+        data = (parameters or kwparameters)["data"]
+        self.rows.extend(data)
+        return [[len(self.rows) - len(data) + i] for i in range(len(data))]
+
+def test_merge_duplicates():
+    n1 = _merge_node("test", id=1, name="a")
+    n2 = _merge_node("test", id=1, name="b")
+    n3 = _merge_node("test", id=2)
+    tx = _StubTx()
+    Subgraph(nodes=[n1, n2, n3]).__db_merge__(tx)
+    # every primary value is only sent once
+    assert len(tx.rows) == 2
+    # all nodes of a value receive the identity of the merged node
+    assert n1.identity is not None
+    assert n1.identity == n2.identity
+    assert n3.identity is not None
+    assert n3.identity != n1.identity